@@ -47,12 +47,24 @@
 
 
 from operator import *
+from collections import deque
+import re
 import sys
 
 # types used for strings and numbers
 STRT = str
 NUMT = float
 
+# commands are stored as the ordinal of their char and looked up in
+# tables with one slot for every possible char
+NCHARS = 256
+
+# truth values as numbers, indexed by a bool (BOOLNUM[x > y])
+BOOLNUM = (NUMT(0), NUMT(1))
+
+# one-char strings by char code (CHARS[65] == 'A')
+CHARS = tuple([chr(i) for i in range(256)])
+
 ### helper functions ###
 def typedesc(type):
    if type==STRT: return "string"
@@ -92,27 +104,30 @@ def ordsuffix(num):
 #####
 
 # stack class
+# the values live in a deque, so moving or inserting an element n places
+# from either end only shifts the n elements in between, not the whole stack
+# (n is always an int, the interpreter converts stack indexes once when
+# it pops them)
 class Stack:
 
    stack = None
    
    def __init__(self, copystack=None):
       if copystack:
-         self.stack = copystack[:]
+         self.stack = deque(copystack)
       else:
-         self.stack = []
+         self.stack = deque()
 
 
+   # numbers have to be pushed as NUMT already, so that all numbers on
+   # the stack use the same type
    def push(self, value):
-      # make sure all numbers use the same type
-      if type(value) in [bool, int]: value = NUMT(value)
       self.stack.append(value)
  
    def pop(self):
       return self.stack.pop()
 
    def swapn(self, n):
-      n=int(n)
       foo = self.stack[-1-n]
       self.stack[-1-n] = self.stack[-1]
       self.stack[-1] = foo
@@ -122,29 +137,33 @@ class Stack:
    swap3 = lambda s: s.swapn(3)
  
    def copy(self, n):
-      n=int(n)
       self.stack.append(self.stack[-1-n])
 
    dup = lambda s: s.copy(0)
    
    def move(self, n):
-      n=int(n)
-      self.stack.append(self.stack[-1-n])
+      foo = self.stack[-1-n]
       del self.stack[-1-n]
+      self.stack.append(foo)
 
+   # same position as list.insert(-n-1, value) would give, done by
+   # rotating the elements above it out of the way and back
    def insert(self, n, value):
-      n=int(n)
-      self.stack.insert(-n-1, value)
+      size = len(self.stack)
+      if n >= 0: above = min(n+1, size)
+      else: above = size - min(-n-1, size)
+      self.stack.rotate(above)
+      self.stack.append(value)
+      self.stack.rotate(-above)
 
    # 'inverted' copy/move = copy/move counting from the bottom of the stack
    def invcopy(self, n):
-      n=int(n)
       self.stack.append(self.stack[n])
    
    def invmove(self, n):
-      n=int(n)
-      self.stack.append(self.stack[n])
+      foo = self.stack[n]
       del self.stack[n]
+      self.stack.append(foo)
 
    # getitem/setitem/len
    def __getitem__(self, n):
@@ -157,54 +176,84 @@ class Stack:
 
 # parser
 class Parser:
-   CONSTANT, COMMAND = range(2)
+   CONST_NUM, CONST_STR, COMMAND = range(3)
+   # precompiled operation, the value is a function to call with the
+   # interpreter (only appears in code specialized by the interpreter)
+   OP = 3
 
-   # program will be made up of a list of these
+   # only used to format items for traces and error messages,
+   # the program itself is kept as two parallel lists (see parse)
    class Item:
       def __init__(self, type, value):
-         if type in (Parser.CONSTANT, Parser.COMMAND):
+         if type in (Parser.CONST_NUM, Parser.CONST_STR, Parser.COMMAND):
             self.type=type
             self.value=value
-         else: raise TypeError, "item type invalid: %d" % type
+         else: raise TypeError("item type invalid: %d" % type)
       
       def __str__(self):
-         if self.type==Parser.COMMAND: return self.value
-         elif self.type==Parser.CONSTANT:
-            if isinstance(self.value, str): return "[%s]" % self.value
-            else: return str(self.value)
+         if self.type==Parser.COMMAND: return chr(self.value)
+         elif self.type==Parser.CONST_STR: return "[%s]" % self.value
+         else: return str(self.value)
+
+   brackets = re.compile(r'[][]')
+
+   # takes string, returns a dict mapping the position of every [ that
+   # starts a string constant to the position of its matching ].
+   # only looks at the brackets, anything wrong with them is left for
+   # parse to report when it gets there
+   @staticmethod
+   def matchbrackets(string):
+      ends = {}
+      lvl = 0
+      for m in Parser.brackets.finditer(string):
+         if string[m.start()] == '[':
+            if lvl == 0: start = m.start()
+            lvl += 1
+         elif lvl > 0:
+            lvl -= 1
+            if lvl == 0: ends[start] = m.start()
+      return ends
 
-   # takes string, returns list of items
+   # takes string, returns (types, values): a bytearray of item types
+   # and a list of the item values at the same positions
+   # (the value of a command is the ordinal of its char)
    @staticmethod
    def parse(string):
-      items = []
+      types = bytearray()
+      values = []
+      ends = Parser.matchbrackets(string)
       i = 0
       while i<len(string):
+         c = string[i]
          # numbers
-         if string[i] in "0123456789": 
-            items.append(Parser.Item(Parser.CONSTANT, NUMT(string[i])))
+         if c in "0123456789": 
+            types.append(Parser.CONST_NUM)
+            values.append(NUMT(c))
          # strings
-         elif string[i] == '[':
-            curstr = ''
-            lvl = 1
-            while lvl>0:
-               i += 1
-               if (i>=len(string) and lvl>0):
-                  raise ValueError(errstr(string, "unterminated [", i-1))
-               if string[i] == ']': lvl -= 1
-               elif string[i] == '[': lvl += 1
-               if (lvl!=0): curstr += string[i]
-            items.append(Parser.Item(Parser.CONSTANT, curstr))
+         elif c == '[':
+            end = ends.get(i)
+            if end is None:
+               raise ValueError(errstr(string, "unterminated [",
+                                       len(string)-1))
+            types.append(Parser.CONST_STR)
+            values.append(string[i+1:end])
+            i = end
          # whitespace is ignored
-         elif string[i] in ' \n\t': pass
+         elif c in ' \n\t': pass
          # ] without [ == error
-         elif string[i] == ']':
+         elif c == ']':
             raise ValueError(errstr(string, "] without [", i))
          # not one of these == command
          else:
-            items.append(Parser.Item(Parser.COMMAND, string[i]))
+            c = ord(c)
+            # command tables only cover byte values
+            if c >= NCHARS:
+               raise ValueError(errstr(string, "invalid character", i))
+            types.append(Parser.COMMAND)
+            values.append(c)
          i += 1
    
-      return items
+      return types, values
 
 class Interpreter:
 
@@ -212,25 +261,50 @@ class Interpreter:
    class CodeError(Exception): pass;
 
    world = None
-   code = None
+   ctypes = None # item types, see Parser.parse
+   cvalues = None # item values
+   prefixes = None # specialized starts of the code, see specialize
    stack = None
    ip = 0
    activeset = 0
+   trace = False
    sets = None # command sets, see init
+   dispatchsets = None # per-set dispatch tables with set 0 merged in,
+                       # indexed by command ordinal
+   dispatch = None # dispatch table for the active set
    parent = None
 
-   def __init__(self,world,code,stack=None,ip=0,activeset=0,parent = None):
-      self.world = world
-      self.code = code
-      if stack==None:
-         self.stack = Stack()
-      else:
-         self.stack = stack
-      self.ip = ip 
-      self.activeset = activeset
-      self.parent = None
+   # interpreters that are done running, for World.recurse to reuse
+   # instead of building a new one with all its command sets each time.
+   # exec nesting is usually shallow, so a few are enough
+   pool = []
+   poolsize = 8
 
+   def __init__(self,world,code,stack=None,ip=0,activeset=0,parent = None,
+                trace=False):
       s=self # makes the huge list less long
+
+      # commands that are a function wrapped in stack handling get their
+      # wrappers built once here instead of on every call
+      ## set 1 ##
+      s.cToStr = s.unarystackf(s.v2str, NUMT)
+      s.cToNum = s.unarystackf(s.tonum, STRT)
+      s.cConcatenate = s.binstackf(add, STRT, STRT)
+      s.cOutput = s.unarystackf(s.outline, pushresult=False)
+      s.cInlineOutput = s.unarystackf(s.outinline, pushresult=False)
+      s.cStrLen = s.unarystackf((lambda strn: NUMT(len(strn))), STRT)
+      s.cCopy = s.indexstackf(Stack.copy)
+      s.cMove = s.indexstackf(Stack.move)
+      ## set 2 ##
+      s.cInsert = s.binstackf(s.insertat, btype=NUMT, pushresult=False)
+      s.cExec = s.unarystackf(s.execstr, STRT, False)
+      ## set 3 ##
+      s.cIsNumber = s.unarystackf(lambda v: BOOLNUM[isinstance(v,NUMT)])
+      s.cIsString = s.unarystackf(lambda v: BOOLNUM[isinstance(v,STRT)])
+      s.cCharAt = s.binstackf(s.charat, STRT, NUMT)
+      s.cInvertedCopy = s.indexstackf(Stack.invcopy)
+      s.cInvertedMove = s.indexstackf(Stack.invmove)
+
       s.sets = [
           # instruction set 0 #
           { 'e' : s.activateSet1,
@@ -294,67 +368,241 @@ class Interpreter:
             'h' : s.cSwap3,
           }
       ]
+
+      # command set 0 has priority above everything, so merge it on top
+      # of every set once instead of looking in two places each step
+      s.dispatchsets = []
+      for cmdset in s.sets:
+         table = [None] * NCHARS
+         for char, handler in list(cmdset.items()) + list(s.sets[0].items()):
+            table[ord(char)] = handler
+         s.dispatchsets.append(table)
+
+      s.reset(world, code, stack, ip, activeset, parent, trace)
+
+   # set up to run (other) code, keeping the command sets
+   # the commands look up the stack, world etc. when they run, so they
+   # work with whatever is set here
+   def reset(self,world,code,stack=None,ip=0,activeset=0,parent = None,
+             trace=False):
+      self.world = world
+      self.ctypes, self.cvalues, self.prefixes = code
+      if stack==None:
+         self.stack = Stack()
+      else:
+         self.stack = stack
+      self.ip = ip 
+      self.parent = None
+      self.trace = trace
+      self.switchset(activeset)
+
+   # interpreter for running code in world as a subroutine of prevint
+   # (on its stack, starting in its set), taken from the pool if possible
+   @staticmethod
+   def fromPool(world, code, prevint):
+      args = (world, code, prevint.stack, 0, prevint.activeset, prevint,
+              prevint.trace)
+      if Interpreter.pool:
+         sub = Interpreter.pool.pop()
+         sub.reset(*args)
+         return sub
+      return Interpreter(*args)
+
+   # put a finished interpreter back in the pool, unless it's full
+   def toPool(self):
+      if len(Interpreter.pool) < Interpreter.poolsize:
+         # don't keep the world, code and stack of the finished run alive
+         self.world = self.stack = self.parent = None
+         self.ctypes = self.cvalues = self.prefixes = None
+         Interpreter.pool.append(self)
  
    # step function
    # returns True if there are more steps, False if not.
    def step(self):
-      if self.ip >= len(self.code):
+      if self.ip >= len(self.ctypes):
          return False # at the end of the code
       
-      curitem = self.code[self.ip]
- 
-      # if there's a trace variable defined and true, give a trace
-      try: 
-         global trace
-         if trace: 
-            print "\x1b[7m",  
-            print "trace: cur=", self.ip, str(curitem), "set=", self.activeset, "stack=", self.stack.stack,
-            print "\x1b[0m"
-      except: pass
-
-      if curitem.type == Parser.CONSTANT:
+      t = self.ctypes[self.ip]
+      v = self.cvalues[self.ip]
+
+      if t != Parser.COMMAND:
          # this is a constant value, push it
-         self.sf(self.stack.push, [curitem.value])
+         self.stack.stack.append(v)
       else:
-         # it's a command
-         if curitem.value in self.sets[0]:
-            # command set 0 has priority above everything
-            self.sets[0][curitem.value]()
-         else:
-            # get it from selected set
-            if self.activeset<0 or self.activeset>=len(self.sets):
-               # selected set is invalid
-               raise Interpreter.CodeError(self.err("no such set: %d",
-                                               self.activeset))
-            else:
-               if not curitem.value in self.sets[self.activeset]:
-                  #invalid command for selected set
-                  raise Interpreter.CodeError(self.err(
-                         "set %d has no command '%s'"%( self.activeset, \
-                                                   curitem.value)))           
-               else:
-                  #yay it's good, run it
-                  try:
-                     self.sets[self.activeset][curitem.value]()
-                  except ZeroDivisionError, complaint:
-                     raise Interpreter.CodeError(self.err(
-                         "division by zero (%s)"%complaint))
+         # it's a command, look it up in the active set
+         handler = self.dispatch[v]
+         if handler is None:
+            #invalid command for selected set
+            raise Interpreter.CodeError(self.err(
+                   "set %d has no command '%s'"%(self.activeset, chr(v))))
+         try:
+            handler()
+         except ZeroDivisionError as complaint:
+            raise Interpreter.CodeError(self.err(
+                "division by zero (%s)"%complaint))
       self.ip += 1  
       return True   
 
+   # run the code until the end
+   # does the same as calling step until it returns False, but with the
+   # loop state in local variables
+   def run(self):
+      if self.trace:
+         while self.tracestep(): pass
+         return
+
+      if self.ip == 0:
+         # start with the specialized version of the code, if there is one.
+         # code that runs only once (like the main program) isn't worth
+         # specializing, so the first run from the start just marks it
+         s = self.activeset
+         if s not in self.prefixes:
+            self.prefixes[s] = False
+         elif self.prefixes[s] is False:
+            self.prefixes[s] = self.specialize()
+         prefix = self.prefixes[s]
+         if prefix: self.execute(*prefix)
+      self.execute(self.ctypes, self.cvalues)
+
+   # run items from ip until the end of the given code
+   def execute(self, ctypes, cvalues):
+      push = self.stack.stack.append
+      COMMAND = Parser.COMMAND
+      end = len(ctypes)
+      ip = self.ip
+      try:
+         while ip < end:
+            t = ctypes[ip]
+            if t < COMMAND:
+               # constants can't fail, so ip doesn't have to be stored
+               push(cvalues[ip])
+               ip += 1
+               continue
+            # commands can use ip for errors or change it (skip)
+            self.ip = ip
+            if t == COMMAND:
+               handler = self.dispatch[cvalues[ip]]
+               if handler is None:
+                  raise Interpreter.CodeError(self.err(
+                         "set %d has no command '%s'"%(self.activeset,
+                                                       chr(cvalues[ip]))))
+               handler()
+            else:
+               cvalues[ip](self)
+            ip = self.ip + 1
+      except ZeroDivisionError as complaint:
+         raise Interpreter.CodeError(self.err(
+             "division by zero (%s)"%complaint))
+      self.ip = ip
+
+   # how commands change the stack, for specialize:
+   # (set, char) -> (number of values popped, types of values pushed),
+   # None as a type means any type.
+   # commands that aren't listed here leave nothing known about the stack
+   effects = {
+      (1,'a'): (2,[NUMT]), (1,'s'): (2,[NUMT]), (1,'m'): (2,[NUMT]),
+      (1,'d'): (2,[NUMT]), (1,'t'): (1,[STRT]), (1,'i'): (1,[None]),
+      (1,'c'): (2,[STRT]), (1,'o'): (1,[]), (1,'q'): (1,[]),
+      (1,'n'): (0,[NUMT]), (1,'l'): (0,[STRT]), (1,'h'): (3,[STRT]),
+      (1,'y'): (1,[NUMT]), (1,'v'): (1,[]), (1,'p'): (1,[None]),
+      (1,'r'): (0,[NUMT]),
+      (2,'u'): (2,[NUMT]), (2,'d'): (2,[NUMT]), (2,'a'): (2,[NUMT]),
+      (2,'o'): (2,[NUMT]), (2,'n'): (1,[NUMT]), (2,'q'): (2,[NUMT]),
+      (2,'l'): (2,[NUMT]), (2,'r'): (2,[NUMT]),
+      (3,'n'): (1,[NUMT]), (3,'s'): (1,[NUMT]), (3,'a'): (2,[NUMT]),
+      (3,'o'): (2,[NUMT]), (3,'i'): (1,[NUMT]), (3,'m'): (2,[NUMT]),
+      (3,'t'): (1,[STRT]), (3,'c'): (2,[NUMT]), (3,'r'): (3,[STRT]),
+      (3,'p'): (1,[None])
+   }
+   swaps = { (3,'b'): 1, (3,'d'): 2, (3,'h'): 3 }
+   # commands that can change ip, specialization stops there
+   jumps = [ (2,'s'), (2,'t'), (3,'q') ]
+
+   # make a specialized version of the start of the code, for running
+   # it from ip 0 with the current active set.
+   # follows the types on the stack as far as the code is sure to run
+   # straight through (up to the first skip or command from an unknown
+   # set), and replaces commands whose operands are known to be numbers
+   # by versions that don't check them.
+   # returns (types, values) for that part of the code, or None if
+   # nothing could be specialized
+   def specialize(self):
+      ptypes = bytearray()
+      pvalues = []
+      found = False
+      known = [] # types of the values known to be on top of the stack
+      cmdset = self.activeset
+      for t, v in zip(self.ctypes, self.cvalues):
+         if t == Parser.CONST_NUM: known.append(NUMT)
+         elif t == Parser.CONST_STR: known.append(STRT)
+         else:
+            c = chr(v)
+            if c in self.sets[0]:
+               if c in 'efg': cmdset = 'efg'.index(c) + 1
+               elif c == 'x':
+                  cmdset = None # can't know which set comes next
+                  if known: known.pop()
+               elif c == 'j': known.append(NUMT)
+            elif cmdset is None: break
+            elif (cmdset, c) in Interpreter.unchecked and \
+                     known[-2:] == [NUMT, NUMT]:
+               t = Parser.OP
+               v = Interpreter.unchecked[(cmdset, c)]
+               found = True
+               known.pop()
+            elif (cmdset, c) in Interpreter.effects:
+               npop, pushed = Interpreter.effects[(cmdset, c)]
+               if len(known) >= npop:
+                  if npop: del known[-npop:]
+               else: known = []
+               known.extend(pushed)
+            elif (cmdset, c) in Interpreter.swaps:
+               n = Interpreter.swaps[(cmdset, c)]
+               if len(known) > n:
+                  known[-1], known[-1-n] = known[-1-n], known[-1]
+               else: known = []
+            elif (cmdset, c) == (1,'u'):
+               if known: known.append(known[-1])
+            elif (cmdset, c) in Interpreter.jumps or \
+                    c not in self.sets[cmdset]:
+               break
+            else: known = []
+         ptypes.append(t)
+         pvalues.append(v)
+      if not found: return None
+      return ptypes, pvalues
+
+   # step function that gives a trace of each step first
+   def tracestep(self):
+      if self.ip < len(self.ctypes):
+         curitem = Parser.Item(self.ctypes[self.ip], self.cvalues[self.ip])
+         print("\x1b[7m", "trace: cur=", self.ip, str(curitem), "set=",
+               self.activeset, "stack=", list(self.stack.stack), "\x1b[0m")
+      return self.step()
+
+   # select the active instruction set
+   def switchset(self, n):
+      self.activeset = n
+      self.dispatch = self.dispatchsets[n]
+
    # make an error string with error & current state
    def err(self, error):
-      return items_errstr(self.code, error, self.ip)
+      code = [Parser.Item(t, v) for t, v in zip(self.ctypes, self.cvalues)]
+      return items_errstr(code, error, self.ip)
 
 
    # call stack function and catch its errors
+   # (only needed for ones that can run out of stack, pushing can't fail)
    def sf(self, func, args):
       rv=None
       try: rv = func(*args)
-      except IndexError, complaint:
-         raise Interpreter.CodeError(self.err("stack error (%s)"%complaint))
+      except IndexError as complaint: self.raiseStackErr(complaint)
       return rv
 
+   # raise a stack error
+   def raiseStackErr(self, complaint):
+      raise Interpreter.CodeError(self.err("stack error (%s)"%complaint))
+
    # raise a type error
    def raiseTypeErr(self, expected, got):
       raise Interpreter.CodeError(
@@ -371,7 +619,17 @@ class Interpreter:
             self.raiseTypeErr(ntype, type(a))
 
          res = f(a)
-         if pushresult: self.sf(self.stack.push,[res])
+         if pushresult: self.stack.stack.append(res)
+      return stackfunc
+
+   # convert a Stack method f(stack, n) into f(self.stack, int(pop())) +
+   # type checking, for the commands that take a stack index
+   def indexstackf(self, f):
+      def stackfunc():
+         n = self.sf(self.stack.pop,[])
+         if not isinstance(n, NUMT):
+            self.raiseTypeErr(NUMT, type(n))
+         f(self.stack, int(n))
       return stackfunc
 
    # convert a function f(a,b) into b=pop(),a=pop(),push(f(a,b)) + type checking
@@ -384,26 +642,8 @@ class Interpreter:
          if atype and not isinstance(a, atype):
             self.raiseTypeErr(atype, type(a))
          res=f(a,b)
-         if pushresult: self.sf(self.stack.push,[res])
+         if pushresult: self.stack.stack.append(res)
       return stackfunc
-   
-   # and now one with three arguments f(a,b,c) 
-   def tristackf(self, f, atype=None, btype=None, ctype=None, pushresult=True):
-      x = self.sf
-      y = self.stack.pop
-      def stackfunc():
-         c = x(y,[])
-         b = x(y,[])
-         a = x(y,[])
-         if ctype and not isinstance(c,ctype):
-            self.raiseTypeErr(ctype, type(c))
-         if btype and not isinstance(b,btype):
-            self.raiseTypeErr(btype, type(b))
-         if atype and not isinstance(a,atype): 
-            self.raiseTypeErr(atype, type(a))
-         res = f(a,b,c)
-         if pushresult: self.sf(self.stack.push,[res])
-      return stackfunc 
         
    ## set 0 ##
    def cActivateSet(self):
@@ -414,23 +654,61 @@ class Interpreter:
       if len(self.sets)<=int(set) or int(set)<0: 
          raise Interpreter.CodeError(
                                self.err("no instruction set %d exists" % set))
-      self.activeset = int(set)
+      self.switchset(int(set))
    
-   def activateSet1(self): self.activeset = 1
-   def activateSet2(self): self.activeset = 2
-   def activateSet3(self): self.activeset = 3
+   def activateSet1(self): self.switchset(1)
+   def activateSet2(self): self.switchset(2)
+   def activateSet3(self): self.switchset(3)
 
    def cGetSet(self):
-      self.sf(self.stack.push,[self.activeset])
+      self.stack.stack.append(NUMT(self.activeset))
  
    def cNop(self): pass
 
    ## set 1 ##
-   def cDuplicate(self): self.sf(self.stack.dup,[])
-   def cAdd(self): self.binstackf(add, NUMT, NUMT)()
-   def cSub(self): self.binstackf(sub, NUMT, NUMT)()
-   def cMul(self): self.binstackf(mul, NUMT, NUMT)()
-   def cDiv(self): self.binstackf(div, NUMT, NUMT)()
+   def cDuplicate(self):
+      st = self.stack.stack
+      try: st.append(st[-1])
+      except IndexError as complaint: self.raiseStackErr(complaint)
+
+   # arithmetic is hot, so these work on the stack's list directly
+   # instead of going through binstackf and sf
+   def cAdd(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         a = st[-1]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(b, NUMT): self.raiseTypeErr(NUMT, type(b))
+      if not isinstance(a, NUMT): self.raiseTypeErr(NUMT, type(a))
+      st[-1] = a + b
+   def cSub(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         a = st[-1]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(b, NUMT): self.raiseTypeErr(NUMT, type(b))
+      if not isinstance(a, NUMT): self.raiseTypeErr(NUMT, type(a))
+      st[-1] = a - b
+   def cMul(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         a = st[-1]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(b, NUMT): self.raiseTypeErr(NUMT, type(b))
+      if not isinstance(a, NUMT): self.raiseTypeErr(NUMT, type(a))
+      st[-1] = a * b
+   def cDiv(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         a = st[-1]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(b, NUMT): self.raiseTypeErr(NUMT, type(b))
+      if not isinstance(a, NUMT): self.raiseTypeErr(NUMT, type(a))
+      st[-1] = a / b
 
    # shortest representation of value in string
    def v2str(self, n):
@@ -442,58 +720,85 @@ class Interpreter:
          except: v=str(n)
       return v
 
-   def cToStr(self): self.unarystackf(self.v2str, NUMT)()
-   def cToNum(self): 
-      def tonum(s):
-         # return a number from the string if possible,
-         # if not a valid number then push the string back
-         try: n = NUMT(s)
-         except ValueError: n = s
-         return n
-      self.unarystackf(tonum, STRT)()
-   def cConcatenate(self): self.binstackf(add, STRT, STRT)() 
-   def cOutput(self):             
-      self.unarystackf(
-             (lambda s:self.world.out(self.v2str(s)+"\n")),pushresult=False)()
-   def cInlineOutput(self): 
-      self.unarystackf(
-             (lambda s:self.world.out(self.v2str(s))),pushresult=False)()
+   # cToStr, cToNum, cConcatenate, cOutput, cInlineOutput, cStrLen,
+   # cCopy and cMove are built in __init__
+
+   def tonum(self, s):
+      # return a number from the string if possible,
+      # if not a valid number then push the string back
+      try: n = NUMT(s)
+      except ValueError: n = s
+      return n
+   def outline(self, s): self.world.out(self.v2str(s)+"\n")
+   def outinline(self, s): self.world.out(self.v2str(s))
    def cReadChar(self): 
-      self.sf(self.stack.push, [NUMT(self.world.readchar())])
+      self.stack.stack.append(NUMT(self.world.readchar()))
    def cReadLine(self):
-      self.sf(self.stack.push, [self.world.readline()])
+      self.stack.stack.append(self.world.readline())
      
    def cSubstring(self):
-      self.tristackf((lambda strn,start,end:strn[int(start):int(end)]),
-                             STRT,NUMT,NUMT)()
-   def cStrLen(self): self.unarystackf(len, STRT)()
+      st = self.stack.stack
+      try:
+         end = st.pop()
+         start = st.pop()
+         strn = st[-1]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(end, NUMT): self.raiseTypeErr(NUMT, type(end))
+      if not isinstance(start, NUMT): self.raiseTypeErr(NUMT, type(start))
+      if not isinstance(strn, STRT): self.raiseTypeErr(STRT, type(strn))
+      st[-1] = strn[int(start):int(end)]
    def cDiscard(self): self.sf(self.stack.pop, [])
-   def cCopy(self): self.unarystackf(self.stack.copy, NUMT, False)()
-   def cMove(self): self.unarystackf(self.stack.move, NUMT, False)()
    def cStackSize(self):
-      self.sf(self.stack.push, NUMT(len(self.stack)))
+      self.stack.stack.append(NUMT(len(self.stack)))
    
    ## set 2 ##
-   def cGT(self): self.binstackf(gt)()
-   def cLT(self): self.binstackf(lt)()
+   def cGT(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         st[-1] = BOOLNUM[st[-1] > b]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      except TypeError: self.raiseTypeErr(type(b), type(st[-1]))
+   def cLT(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         st[-1] = BOOLNUM[st[-1] < b]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      except TypeError: self.raiseTypeErr(type(b), type(st[-1]))
    def cSkip(self):
-      def skip(n): self.ip += int(n)
-      self.unarystackf(skip,NUMT,False)()
+      try: n = self.stack.stack.pop()
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(n, NUMT): self.raiseTypeErr(NUMT, type(n))
+      self.ip += int(n)
    def cSkipTwo(self):
-      def skip2(n): self.ip += int(n*2)
-      self.unarystackf(skip2,NUMT,False)()
-   def cInsert(self):
-      def insert(thing, where): self.stack.insert(where, thing)
-      self.binstackf(insert, btype=NUMT, pushresult=False)()
-   def cAnd(self): self.binstackf(lambda a,b:NUMT(a and b and 1 or 0))()
-   def cOr(self): self.binstackf(lambda a,b:NUMT((a or b) and 1 or 0))()
-   def cNot(self): self.unarystackf(lambda a:NUMT(not a and 1 or 0))()
+      try: n = self.stack.stack.pop()
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(n, NUMT): self.raiseTypeErr(NUMT, type(n))
+      self.ip += int(n*2)
+   # cInsert and cExec are built in __init__
+   def insertat(self, thing, where): self.stack.insert(int(where), thing)
+   def cAnd(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         st[-1] = BOOLNUM[bool(st[-1] and b)]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+   def cOr(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         st[-1] = BOOLNUM[bool(st[-1] or b)]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+   def cNot(self):
+      st = self.stack.stack
+      try: st[-1] = BOOLNUM[not st[-1]]
+      except IndexError as complaint: self.raiseStackErr(complaint)
    
   
    def execstr(self, codestr):
       self.world.recurse(self, codestr)
 
-   def cExec(self): self.unarystackf(self.execstr,STRT,False)()
    def cWhile(self):
       while True:
          # pop a value
@@ -507,9 +812,30 @@ class Interpreter:
                self.execstr(code)
          else:
             break
-   def cEqual(self): self.binstackf(eq)()
-   def cLshift(self): self.binstackf((lambda a,b:int(a)<<int(b)),NUMT,NUMT)()
-   def cRshift(self): self.binstackf((lambda a,b:int(a)>>int(b)),NUMT,NUMT)()
+   def cEqual(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         st[-1] = BOOLNUM[st[-1] == b]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+   def cLshift(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         a = st[-1]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(b, NUMT): self.raiseTypeErr(NUMT, type(b))
+      if not isinstance(a, NUMT): self.raiseTypeErr(NUMT, type(a))
+      st[-1] = NUMT(int(a) << int(b))
+   def cRshift(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         a = st[-1]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(b, NUMT): self.raiseTypeErr(NUMT, type(b))
+      if not isinstance(a, NUMT): self.raiseTypeErr(NUMT, type(a))
+      st[-1] = NUMT(int(a) >> int(b))
    
    ## set 3 ##
   
@@ -522,45 +848,107 @@ class Interpreter:
       while self.sf(self.stack.pop,[]):
          self.execstr(code)
    
-   def cIsNumber(self):
-      self.unarystackf(lambda v: isinstance(v,NUMT) and 1 or 0)()
-   def cIsString(self):
-      self.unarystackf(lambda v: isinstance(v,STRT) and 1 or 0)()
+   # cIsNumber, cIsString, cCharAt, cInvertedCopy and cInvertedMove
+   # are built in __init__
+
    # binary and/or use integers again
-   def binop(self,op): return lambda a,b: op(int(a), int(b))
-   def cBinAnd(self): self.binstackf(self.binop(and_), NUMT, NUMT)()
-   def cBinOr(self): self.binstackf(self.binop(or_), NUMT, NUMT)()
-   def cInteger(self): self.unarystackf(int, NUMT)()
-   def cMod(self): self.binstackf(mod, NUMT, NUMT)()
-   def cToChar(self): self.unarystackf((lambda k:chr(int(k)%256)), NUMT)()
-   def cCharAt(self): 
-      def charat(strn, idx):
-         idx=int(idx)
-         if (idx<0 or idx>=len(strn)):
-            # nowhere in the spec it says python-style negative indexes
-            # are allowed...
-            raise Interpreter.CodeError(self.err(
-                   ("index out of bounds: tried to get %d-char string's " +\
-                    "%d%s character") % (len(strn), idx, ordsuffix(idx)) ))
-         return NUMT(ord(strn[idx]))
-      self.binstackf(charat, STRT, NUMT)()
+   def cBinAnd(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         a = st[-1]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(b, NUMT): self.raiseTypeErr(NUMT, type(b))
+      if not isinstance(a, NUMT): self.raiseTypeErr(NUMT, type(a))
+      st[-1] = NUMT(int(a) & int(b))
+   def cBinOr(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         a = st[-1]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(b, NUMT): self.raiseTypeErr(NUMT, type(b))
+      if not isinstance(a, NUMT): self.raiseTypeErr(NUMT, type(a))
+      st[-1] = NUMT(int(a) | int(b))
+   def cInteger(self):
+      st = self.stack.stack
+      try: a = st[-1]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(a, NUMT): self.raiseTypeErr(NUMT, type(a))
+      st[-1] = NUMT(int(a))
+   def cMod(self):
+      st = self.stack.stack
+      try:
+         b = st.pop()
+         a = st[-1]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(b, NUMT): self.raiseTypeErr(NUMT, type(b))
+      if not isinstance(a, NUMT): self.raiseTypeErr(NUMT, type(a))
+      st[-1] = a % b
+   def cToChar(self):
+      st = self.stack.stack
+      try: k = st[-1]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(k, NUMT): self.raiseTypeErr(NUMT, type(k))
+      st[-1] = CHARS[int(k) & 0xff]
+   def charat(self, strn, idx):
+      idx=int(idx)
+      if (idx<0 or idx>=len(strn)):
+         # nowhere in the spec it says python-style negative indexes
+         # are allowed...
+         raise Interpreter.CodeError(self.err(
+                ("index out of bounds: tried to get %d-char string's " +\
+                 "%d%s character") % (len(strn), idx, ordsuffix(idx)) ))
+      return NUMT(ord(strn[idx]))
    def cReplaceChar(self):
-      def replacechar(strn, idx, repl):
-         idx=int(idx)
-         if (idx<0 or idx>=len(strn)):
-            raise Interpreter.CodeError(self.err(
-                   ("index out of bounds: tried to change %d-char string's "+\
-                    "%d%s character") % (len(strn), idx, ordsuffix(idx)) ))
-         return strn[:idx] + repl[0] + strn[idx+1:]
-      self.tristackf(replacechar, STRT, NUMT, STRT)()
-   def cInvertedCopy(self):
-      self.unarystackf(self.stack.invcopy, NUMT, False)()
-   def cInvertedMove(self):
-      self.unarystackf(self.stack.invmove, NUMT, False)()
+      st = self.stack.stack
+      try:
+         repl = st.pop()
+         idx = st.pop()
+         strn = st[-1]
+      except IndexError as complaint: self.raiseStackErr(complaint)
+      if not isinstance(repl, STRT): self.raiseTypeErr(STRT, type(repl))
+      if not isinstance(idx, NUMT): self.raiseTypeErr(NUMT, type(idx))
+      if not isinstance(strn, STRT): self.raiseTypeErr(STRT, type(strn))
+      idx=int(idx)
+      if (idx<0 or idx>=len(strn)):
+         raise Interpreter.CodeError(self.err(
+                ("index out of bounds: tried to change %d-char string's "+\
+                 "%d%s character") % (len(strn), idx, ordsuffix(idx)) ))
+      st[-1] = strn[:idx] + repl[0] + strn[idx+1:]
    def cSwap(self): self.sf(self.stack.swap, [])
    def cSwap2(self): self.sf(self.stack.swap2, [])
    def cSwap3(self): self.sf(self.stack.swap3, [])
 
+   ## unchecked versions of commands ##
+   # only used by specialized code, where both operands are known to be
+   # numbers and known to be on the stack
+
+   def uAdd(self):
+      st = self.stack.stack
+      b = st.pop()
+      st[-1] += b
+   def uSub(self):
+      st = self.stack.stack
+      b = st.pop()
+      st[-1] -= b
+   def uMul(self):
+      st = self.stack.stack
+      b = st.pop()
+      st[-1] *= b
+   def uDiv(self):
+      st = self.stack.stack
+      b = st.pop()
+      st[-1] /= b
+   def uMod(self):
+      st = self.stack.stack
+      b = st.pop()
+      st[-1] %= b
+
+   # (set, char) -> unchecked version of that command
+   unchecked = { (1,'a'): uAdd, (1,'s'): uSub, (1,'m'): uMul, (1,'d'): uDiv,
+                 (3,'m'): uMod }
+
 
      
 # class World
@@ -573,24 +961,38 @@ class Interpreter:
 class World:
    interpreter = None
 
-   def __init__(self, codestr, prevint=None):
+   # parsed code by source string, shared by all worlds so loop bodies
+   # that get exec'ed over and over are only parsed once
+   parsecache = {}
+   parsecachesize = 1024
+
+   def __init__(self, codestr, trace=False):
       # parse the code
        
-      self.code = Parser.parse(codestr)
+      self.code = World.parse(codestr)
       
-  
-      if prevint:
-         self.interpreter = Interpreter( self, self.code, 
-                                         parent=prevint,
-                                         stack=prevint.stack,
-                                         activeset=prevint.activeset )
-      else:
-         self.interpreter = Interpreter( self, self.code )
+      self.interpreter = Interpreter( self, self.code, trace=trace )
    
+   # parse code, or get it from the cache if it's been parsed before.
+   # returns (types, values, prefixes), prefixes is a dict where the
+   # interpreter keeps specialized versions of the code
+   @staticmethod
+   def parse(codestr):
+      code = World.parsecache.get(codestr)
+      if code is None:
+         types, values = Parser.parse(codestr)
+         code = (types, values, {})
+         # programs that build code strings on the fly could fill
+         # the cache forever, so start over once it's full
+         if len(World.parsecache) >= World.parsecachesize:
+            World.parsecache.clear()
+         World.parsecache[codestr] = code
+      return code
+
    # run the interpreter until it fails or quits
    def run(self):
       
-      while self.interpreter.step(): pass
+      self.interpreter.run()
      
 
    # the interpreter calls these for program control
@@ -610,18 +1012,20 @@ class World:
 
    def recurse(self, prevint, codestr):
       try:
-         # run the sub-interpreter in its own world
-         w = World(codestr, prevint=prevint)
-         w.run()
-      except ValueError, complaint:
+         # run the sub-interpreter in this world, on the same stack
+         code = World.parse(codestr)
+         sub = Interpreter.fromPool(self, code, prevint)
+         sub.run()
+         sub.toPool()
+      except ValueError as complaint:
          # parsing failed
          raise Interpreter.CodeError(prevint.err(
                   "exec: parsing of string failed: \n\t%s\n" % complaint))
-      except Interpreter.CodeError, complaint:
+      except Interpreter.CodeError as complaint:
          # run-time error in code
          raise Interpreter.CodeError(prevint.err(
                   "exec: sub-interpreter runtime error: \n\t%s\n" % complaint))
-      except Exception, complaint:
+      except Exception as complaint:
          # something else went wrong
          raise Interpreter.CodeError(prevint.err(
                   "exec: sub-interpreter failed: %s" % str(complaint)))
@@ -631,10 +1035,9 @@ class World:
 
 # start the program
 def main(argv):
-   global trace
    if (not len(argv) in (2,3)) or (len(argv)==3 and \
                       (not argv[1] == '-trace')): 
-      print "usage: %s [-trace] filename | -" % argv[0]
+      print("usage: %s [-trace] filename | -" % argv[0])
       sys.exit(2)
    else:
       if argv[1]=='-trace': 
@@ -643,23 +1046,26 @@ def main(argv):
       else:
          trace = False
          fname = argv[1]
+      # treat program and I/O as raw bytes, one char each
+      for stream in (sys.stdin, sys.stdout):
+         stream.reconfigure(encoding='latin-1', newline='')
       try:
          if fname=='-': f = sys.stdin
-         else: f = file(fname, 'r')
+         else: f = open(fname, 'r', encoding='latin-1', newline='')
       except:
-         print "Can't open file %s" % argv[1]
+         print("Can't open file %s" % argv[1])
          sys.exit(3)
       code = f.read()
       f.close()
          
       try:
-         w = World(code)
+         w = World(code, trace=trace)
          w.run()
-      except Interpreter.CodeError, complaint:
-         print "Run-time error: %s" % complaint
-      except ValueError, complaint:
-         print "Parse error: %s" % complaint
-      except Exception, complaint:
-         print "An exception occured: %s" % complaint
+      except Interpreter.CodeError as complaint:
+         print("Run-time error: %s" % complaint)
+      except ValueError as complaint:
+         print("Parse error: %s" % complaint)
+      except Exception as complaint:
+         print("An exception occured: %s" % complaint)
 
 if __name__=="__main__": main(sys.argv)